@@ -1,10 +1,63 @@
+import asyncio
+import io
+import json
 import logging
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from itertools import islice
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.response import StreamingBody
 from sqlalchemy import create_engine
 from pymongo import MongoClient
+try:
+    import aioboto3
+except ImportError:
+    aioboto3 = None
 
 logger = logging.getLogger(__name__)
 
+# Uploads above this size are split into parallel multipart uploads.
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# The number of listed S3 pages that may wait ahead of the page being processed.
+S3_PAGE_PREFETCH = 4
+# How often, in seconds, a blocked listing thread checks whether to give up.
+S3_PAGE_PUT_TIMEOUT = 0.5
+
+# boto3 clients are thread safe but expensive to build, so they are shared
+# per (service, access key). The pool is sized for the parallel S3 workers.
+_clients = {}
+_clients_lock = threading.Lock()
+_client_config = Config(max_pool_connections=32,
+                        retries={'max_attempts': 10, 'mode': 'adaptive'})
+
+
+def _s3_delete_request(page):
+    """
+    Builds the quiet delete_objects request for every key in a listed page.
+    A page holds at most 1000 keys, which is the limit of a single
+    delete_objects call.
+    :param page: dict: A list_objects_v2 page
+    """
+    return {'Objects': [{'Key': item["Key"]} for item in page['Contents']],
+            'Quiet': True}
+
+
+def _log_s3_delete_errors(bucket, response):
+    """
+    Logs every key that a delete_objects call failed to delete.
+    :param bucket: str: The name of the target s3 bucket
+    :param response: dict: The delete_objects response
+    """
+    for error in response.get('Errors', []):
+        logger.error(f"Failed to delete s3://{bucket}/{error['Key']}: "
+                     f"{error['Message']}")
+
 
 class MongoConnector:
     """
@@ -41,6 +94,22 @@ class MongoConnector:
         self.connection.close()
 
 
+@lru_cache(maxsize=None)
+def _get_engine(url, echo=False):
+    """
+    Returns a pooled SQLAlchemy engine for the given connection url.
+    Engines are cached so that every DatabaseConnector pointing at the
+    same database shares a single connection pool.
+    :param url: str: The SQLAlchemy connection url
+    :param echo: bool: Whether SQLAlchemy should log every statement
+    """
+    return create_engine(url,
+                         pool_size=5,
+                         max_overflow=10,
+                         pool_pre_ping=True,
+                         echo=echo)
+
+
 class DatabaseConnector:
     """
     Class that acts as a context manager to manage any SQLAlchemy
@@ -70,15 +139,98 @@ class DatabaseConnector:
         self.password = password
         self.dialect = dialect
         self.database = database
-        self.connection = create_engine(f"""{self.dialect}://{self.user}:{self.password}"""
-                                        f"""@{self.host}:{self.port}/{self.database}""",
-                                        echo=True)
+        self.url = (f"""{self.dialect}://{self.user}:{self.password}"""
+                    f"""@{self.host}:{self.port}/{self.database}""")
+        # Statement logging is expensive on large upserts, so it is opt-in.
+        self.connection = _get_engine(self.url, echo=bool(int(os.getenv("SQL_ECHO", "0"))))
 
     def __enter__(self):
         return self.connection
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.connection.dispose()
+        # The engine and its pool are shared, so connections are
+        # returned to the pool rather than disposed of here.
+        pass
+
+
+class S3MultipartWriter:
+    """
+    A writable file-like object that streams into an S3 object through a
+    multipart upload, sending a part whenever MULTIPART_THRESHOLD bytes
+    have been buffered. Used as a context manager, the upload is completed
+    on exit, or aborted if an exception was raised.
+    :param client: The boto3 s3 client
+    :param bucket: str: Target S3 bucket name
+    :param file_name: str: The name of the file that will be uploaded
+
+    Example:
+    with S3MultipartWriter(client, bucket='bucket_name', file_name='data.csv') as sink:
+        sink.write(b'a,b,c')
+    """
+
+    def __init__(self, client, bucket, file_name):
+        self.client = client
+        self.bucket = bucket
+        self.file_name = file_name
+        self.bytes_written = 0
+        self.parts = []
+        self.buffer = io.BytesIO()
+        self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket,
+                                                             Key=self.file_name)["UploadId"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _upload_part(self):
+        """
+        Uploads the buffered data as the next part and resets the buffer.
+        """
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket,
+                                           Key=self.file_name,
+                                           UploadId=self.upload_id,
+                                           PartNumber=part_number,
+                                           Body=self.buffer.getvalue())
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        """
+        Buffers data and uploads a part once the buffer is large enough.
+        :param data: str or bytes: The data to write
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.write(data)
+        self.bytes_written += len(data)
+        if self.buffer.tell() >= MULTIPART_THRESHOLD:
+            self._upload_part()
+        return len(data)
+
+    def close(self):
+        """
+        Uploads the remaining buffer as the last part and completes the upload.
+        """
+        if self.buffer.tell() > 0 or not self.parts:
+            self._upload_part()
+        self.client.complete_multipart_upload(Bucket=self.bucket,
+                                              Key=self.file_name,
+                                              UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        """
+        Aborts the upload so no parts are left behind in the bucket.
+        """
+        self.client.abort_multipart_upload(Bucket=self.bucket,
+                                           Key=self.file_name,
+                                           UploadId=self.upload_id)
 
 
 class AWSConnector:
@@ -96,39 +248,271 @@ class AWSConnector:
         self.conn_type = conn_type
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
-        self.client = boto3.client(self.conn_type,
-                                   aws_access_key_id=self.aws_access_key_id,
-                                   aws_secret_access_key=self.aws_secret_access_key)
+        with _clients_lock:
+            key = (self.conn_type, self.aws_access_key_id)
+            if key not in _clients:
+                _clients[key] = boto3.client(self.conn_type,
+                                             aws_access_key_id=self.aws_access_key_id,
+                                             aws_secret_access_key=self.aws_secret_access_key,
+                                             config=_client_config)
+            self.client = _clients[key]
+        self.transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                              multipart_chunksize=MULTIPART_THRESHOLD,
+                                              max_concurrency=16)
+
+    @staticmethod
+    def _put_s3_page(pages, page, stopped):
+        """
+        Puts a page into the pages queue, giving up once the consumer has
+        stopped so the listing thread never blocks on a full queue.
+        :param pages: Queue: The queue shared with iterate_s3_bucket_items
+        :param page: The listed page, None or an exception
+        :param stopped: Event: Set by iterate_s3_bucket_items when it exits
+        :return: bool: Whether the page was queued
+        """
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=S3_PAGE_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _list_s3_pages(self, bucket, pages, stopped):
+        """
+        Lists every page of a bucket into the pages queue. A None marks the
+        end of the listing and an exception is forwarded to the consumer.
+        Listing stops early once the stopped event is set.
+        :param bucket: str: The name of the target s3 bucket
+        :param pages: Queue: The queue shared with iterate_s3_bucket_items
+        :param stopped: Event: Set by iterate_s3_bucket_items when it exits
+        """
+        try:
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, PaginationConfig={'PageSize': 1000}):
+                if not self._put_s3_page(pages, page, stopped):
+                    return
+            self._put_s3_page(pages, None, stopped)
+        except Exception as exc:
+            self._put_s3_page(pages, exc, stopped)
+
+    def _fetch_s3_page(self, executor, bucket, page, max_workers):
+        """
+        Yields the objects of a listed page in completion order, keeping a
+        sliding window of at most max_workers get_object requests in flight.
+        Requests that have not started are cancelled if iteration ends early.
+        :param executor: ThreadPoolExecutor: The pool the requests run on
+        :param bucket: str: The name of the target s3 bucket
+        :param page: dict: A list_objects_v2 page
+        :param max_workers: int: The number of concurrent S3 requests
+        """
+        keys = (item["Key"] for item in page['Contents'])
+        pending = set()
+        try:
+            while True:
+                for key in islice(keys, max_workers - len(pending)):
+                    pending.add(executor.submit(self.client.get_object, Bucket=bucket, Key=key))
+                if not pending:
+                    return
 
-    def iterate_s3_bucket_items(self, bucket, method):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def iterate_s3_bucket_items(self, bucket, method, max_workers=16):
         """
         To iterate through S3 objects, use:
             for i in iterate_bucket_items(bucket='bucket_name'):
                 print(i["Body"].read().decode('utf-8'))
+        Pages are listed in a background thread while the current page is
+        processed. Fetches for the objects in each page run on a thread pool
+        with at most max_workers requests in flight, and fetched objects are
+        yielded in completion order.
+        Deletes are issued as one batched request per page.
         :param bucket: str: The name of the target s3 bucket
         :param method: str: 'fetch' to return all objects, 'delete'
         to delete all objects
+        :param max_workers: int: The number of concurrent S3 requests
         """
 
-        paginator = self.client.get_paginator('list_objects_v2')
-        page_iterator = paginator.paginate(Bucket=bucket)
+        pages = queue.Queue(maxsize=S3_PAGE_PREFETCH)
+        stopped = threading.Event()
+        threading.Thread(target=self._list_s3_pages, args=(bucket, pages, stopped), daemon=True).start()
 
-        for page in page_iterator:
-            if page['KeyCount'] > 0:
-                for item in page['Contents']:
-                    if method == 'delete':
-                        self.client.delete_object(Bucket=bucket, Key=item["Key"])
-                        continue
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for page in iter(pages.get, None):
+                    if isinstance(page, Exception):
+                        raise page
 
-                    if method == 'fetch':
-                        item_content = self.client.get_object(Bucket=bucket, Key=item["Key"])
-                        yield item_content
+                    if page['KeyCount'] > 0:
+                        if method == 'delete':
+                            response = self.client.delete_objects(Bucket=bucket,
+                                                                  Delete=_s3_delete_request(page))
+                            _log_s3_delete_errors(bucket, response)
+                            continue
+
+                        if method == 'fetch':
+                            yield from self._fetch_s3_page(executor, bucket, page, max_workers)
+        finally:
+            # Releases the listing thread if iteration ends early.
+            stopped.set()
 
     def put_s3_items(self, bucket, file_name, content):
         """
-        Puts s3 items into an s3 bucket.
+        Puts s3 items into an s3 bucket. Content larger than MULTIPART_THRESHOLD
+        is uploaded in parallel parts.
         :param bucket: str: Target S3 bucket name
         :param file_name: str: The name of the file that will be uploaded
-        :param content: str: The content of the file that will be uploaded
+        :param content: str or bytes: The content of the file that will be uploaded
         """
-        self.client.put_object(Bucket=bucket, Key=file_name, Body=content)
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        if len(content) <= MULTIPART_THRESHOLD:
+            self.client.put_object(Bucket=bucket, Key=file_name, Body=content)
+            return
+
+        self.client.upload_fileobj(io.BytesIO(content), bucket, file_name,
+                                   Config=self.transfer_config)
+
+    def open_s3_writer(self, bucket, file_name):
+        """
+        Opens a streaming multipart upload into an s3 bucket.
+        :param bucket: str: Target S3 bucket name
+        :param file_name: str: The name of the file that will be uploaded
+        """
+        return S3MultipartWriter(self.client, bucket=bucket, file_name=file_name)
+
+    def put_s3_manifest(self, bucket, file_name, entries):
+        """
+        Puts a Redshift COPY manifest into an s3 bucket. Every entry is
+        mandatory, so a COPY fails rather than silently skipping a file.
+        :param bucket: str: Target S3 bucket name
+        :param file_name: str: The name of the manifest that will be uploaded
+        :param entries: dict: The staged file names mapped to their content length in bytes
+        """
+        manifest = {"entries": [{"url": f"s3://{bucket}/{key}",
+                                 "mandatory": True,
+                                 "meta": {"content_length": content_length}}
+                                for key, content_length in entries.items()]}
+        self.put_s3_items(bucket=bucket, file_name=file_name, content=json.dumps(manifest))
+
+
+class AsyncAWSConnector(AWSConnector):
+    """
+    An AWSConnector that iterates S3 buckets on an asyncio event loop via
+    the optional aioboto3 extra, issuing the requests of a listed page
+    concurrently. Uploads are inherited from AWSConnector. If aioboto3 is
+    not installed, the threaded AWSConnector implementation is used instead.
+
+    :param conn_type: str: The boto3 service name, e.g. 's3'
+    :param aws_access_key_id: str: AWS access key id value
+    :param aws_secret_access_key: str: AWS secret access key value
+
+    """
+
+    def __init__(self, conn_type, aws_access_key_id, aws_secret_access_key):
+        super().__init__(conn_type, aws_access_key_id, aws_secret_access_key)
+        self.session = aioboto3.Session() if aioboto3 is not None else None
+
+    @staticmethod
+    async def _fetch_s3_page(client, bucket, page, max_workers):
+        """
+        Yields the objects of a listed page in completion order, keeping a
+        sliding window of at most max_workers requests in flight. Each body
+        is read on the loop before it is yielded, so its connection goes back
+        to the pool and the object can be read after iteration has moved on.
+        :param client: The aioboto3 s3 client
+        :param bucket: str: The name of the target s3 bucket
+        :param page: dict: A list_objects_v2 page
+        :param max_workers: int: The number of concurrent S3 requests
+        """
+        async def get_object(key):
+            item_content = await client.get_object(Bucket=bucket, Key=key)
+            body = item_content["Body"]
+            try:
+                data = await body.read()
+            finally:
+                body.close()
+            item_content["Body"] = StreamingBody(io.BytesIO(data), len(data))
+            return item_content
+
+        keys = (item["Key"] for item in page['Contents'])
+        pending = set()
+        try:
+            while True:
+                for key in islice(keys, max_workers - len(pending)):
+                    pending.add(asyncio.ensure_future(get_object(key)))
+                if not pending:
+                    return
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def aiterate_s3_bucket_items(self, bucket, method, max_workers=16):
+        """
+        To iterate through S3 objects, use:
+            async for i in aiterate_s3_bucket_items(bucket='bucket_name', method='fetch'):
+                print(i["Body"].read().decode('utf-8'))
+        :param bucket: str: The name of the target s3 bucket
+        :param method: str: 'fetch' to return all objects, 'delete'
+        to delete all objects
+        :param max_workers: int: The number of concurrent S3 requests
+        """
+        async with self.session.client(self.conn_type,
+                                       aws_access_key_id=self.aws_access_key_id,
+                                       aws_secret_access_key=self.aws_secret_access_key,
+                                       config=_client_config) as client:
+            paginator = client.get_paginator('list_objects_v2')
+            async for page in paginator.paginate(Bucket=bucket, PaginationConfig={'PageSize': 1000}):
+                if page['KeyCount'] > 0:
+                    if method == 'delete':
+                        response = await client.delete_objects(Bucket=bucket,
+                                                               Delete=_s3_delete_request(page))
+                        _log_s3_delete_errors(bucket, response)
+                        continue
+
+                    if method == 'fetch':
+                        fetched = self._fetch_s3_page(client, bucket, page, max_workers)
+                        try:
+                            async for item_content in fetched:
+                                yield item_content
+                        finally:
+                            await fetched.aclose()
+
+    def iterate_s3_bucket_items(self, bucket, method, max_workers=16):
+        """
+        Synchronous facade over aiterate_s3_bucket_items with the same
+        signature as AWSConnector.iterate_s3_bucket_items. Each call runs
+        on its own event loop, so it is safe to use from worker threads.
+        :param bucket: str: The name of the target s3 bucket
+        :param method: str: 'fetch' to return all objects, 'delete'
+        to delete all objects
+        :param max_workers: int: The number of concurrent S3 requests
+        """
+        if self.session is None:
+            yield from super().iterate_s3_bucket_items(bucket, method, max_workers=max_workers)
+            return
+
+        loop = asyncio.new_event_loop()
+        items = self.aiterate_s3_bucket_items(bucket, method, max_workers=max_workers)
+        try:
+            while True:
+                try:
+                    item_content = loop.run_until_complete(items.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield item_content
+        finally:
+            loop.run_until_complete(items.aclose())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
@@ -1,8 +1,33 @@
 import logging
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
 
+def _quote_identifier(name):
+    """
+    Wraps a Redshift identifier in double quotes, escaping any
+    embedded double quotes.
+    :param name: str: The schema, table or column name
+    """
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+@lru_cache(maxsize=32)
+def _render_col_fragments(columns):
+    """
+    Renders the quoted column fragments used by the upsert statements.
+    Column lists rarely change between runs, so the result is cached.
+    :param columns: tuple: The column names of the staged data
+    :return: tuple: The SET, COPY and VALUES column fragments
+    """
+    quoted_columns = [_quote_identifier(col) for col in columns]
+    set_columns = ", ".join(f'{col} = t2.{col}' for col in quoted_columns)
+    copy_columns = ", ".join(quoted_columns)
+    values_columns = ", ".join(f't2.{col}' for col in quoted_columns)
+    return set_columns, copy_columns, values_columns
+
+
 def s3_upsert_to_redshift(conn,
                           schema,
                           redshift_table,
@@ -12,51 +37,70 @@ def s3_upsert_to_redshift(conn,
                           aws_secret_access_key,
                           dataframe,
                           additional_params,
-                          insert_only=False):
+                          insert_only=False,
+                          use_merge=True,
+                          columns=None):
     """
-    This function upserts json or csv data from s3 into
+    This function upserts json, csv or parquet data from s3 into
     a target Redshift table leveraging a SQLAlchemy connection.
 
     :param conn: SQLAlchemy connection object, preferrably in a transaction block.
     :param schema: str: Target Redshift schema name
     :param redshift_table: str: Target Redshift table name
-    :param s3_conn_str: str: The connection string of the target s3 bucket
+    :param s3_conn_str: str: The connection string of the target s3 bucket, prefix or manifest
     :param primary_key: str: The string of the primary key in the target table
     :param aws_access_key_id: str: AWS access key id value
     :param aws_secret_access_key: str: AWS secret access key value
-    :param dataframe: Dataframe: The pandas dataframe containing the target data
+    :param dataframe: Dataframe: The pandas dataframe containing the target data. This can be
+    None if columns is given.
     :param additional_params: str: This field should contain any additional
-    parameters that should be added to the copy statement, namely JSON AS 'auto'
-    or DELIMITER ',' IGNOREHEADER 1.
+    parameters that should be added to the copy statement, namely JSON AS 'auto',
+    DELIMITER ',' IGNOREHEADER 1 or FORMAT AS PARQUET. Add MANIFEST when s3_conn_str
+    points at a manifest.
     :param insert_only: bool: default False. If this is True, the update statement will be skipped
+    :param use_merge: bool: default True. Upserts with a single MERGE statement. Set this to
+    False on clusters that predate MERGE support to use the UPDATE + INSERT statements instead.
+    :param columns: list: default None. The staged column names, used instead of the
+    dataframe's columns when the data was staged without a dataframe.
     """
-    set_columns = ""
-    copy_columns = ""
-    for col in dataframe.columns:
-        set_columns += f'"{col}" = t2."{col}", '
-        copy_columns += f'"{col}", '
-    set_columns = set_columns[0:-2]
-    copy_columns = copy_columns[0:-2]
+    if columns is None:
+        columns = dataframe.columns
+    set_columns, copy_columns, values_columns = _render_col_fragments(tuple(columns))
 
-    conn.execute(f"""CREATE TEMPORARY TABLE {redshift_table}_temp (LIKE {schema}.{redshift_table});""")
+    qualified_table = f'{_quote_identifier(schema)}.{_quote_identifier(redshift_table)}'
+    temp_table = _quote_identifier(f'{redshift_table}_temp')
+    primary_key = _quote_identifier(primary_key)
 
-    conn.execute(f"""COPY {redshift_table}_temp ({copy_columns})
+    # LIKE also inherits the target's dist style and sort keys, so the temp
+    # table is co-located with the target for the upsert join.
+    conn.execute(f"""CREATE TEMPORARY TABLE {temp_table} (LIKE {qualified_table} INCLUDING DEFAULTS);""")
+
+    conn.execute(f"""COPY {temp_table} ({copy_columns})
                      FROM '{s3_conn_str}'
                      access_key_id '{aws_access_key_id}'
                      secret_access_key '{aws_secret_access_key}'
                      {additional_params};""")
 
-    if insert_only is False:
-        conn.execute(f"""UPDATE {schema}.{redshift_table} AS t1
-                         SET {set_columns}
-                         FROM {redshift_table}_temp AS t2
-                         WHERE t1."{primary_key}" = t2."{primary_key}";""")
+    conn.execute(f"""ANALYZE {temp_table};""")
+
+    if insert_only is False and use_merge is True:
+        conn.execute(f"""MERGE INTO {qualified_table} AS t1
+                         USING {temp_table} AS t2
+                         ON t1.{primary_key} = t2.{primary_key}
+                         WHEN MATCHED THEN UPDATE SET {set_columns}
+                         WHEN NOT MATCHED THEN INSERT ({copy_columns}) VALUES ({values_columns});""")
+    else:
+        if insert_only is False:
+            conn.execute(f"""UPDATE {qualified_table} AS t1
+                             SET {set_columns}
+                             FROM {temp_table} AS t2
+                             WHERE t1.{primary_key} = t2.{primary_key};""")
 
-    conn.execute(f"""INSERT INTO {schema}.{redshift_table}
-                     SELECT t2.* FROM {redshift_table}_temp t2 LEFT JOIN {redshift_table} t1
-                     ON t2."{primary_key}" = t1."{primary_key}"
-                     WHERE t1."{primary_key}" IS NULL;""")
+        conn.execute(f"""INSERT INTO {qualified_table}
+                         SELECT t2.* FROM {temp_table} t2 LEFT JOIN {qualified_table} t1
+                         ON t2.{primary_key} = t1.{primary_key}
+                         WHERE t1.{primary_key} IS NULL;""")
 
     # If a delete statement is required, this is what would be used.
-    # conn.execute(f"""DELETE FROM {schema}.{redshift_table}
-    #                  WHERE "{primary_key}" NOT IN (SELECT "{primary_key}" FROM {redshift_table}_temp);""")
+    # conn.execute(f"""DELETE FROM {qualified_table}
+    #                  WHERE {primary_key} NOT IN (SELECT {primary_key} FROM {temp_table});""")
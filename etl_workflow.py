@@ -1,12 +1,21 @@
+import io
 import os
 import logging
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import orjson
 import pandas as pd
-from data_connectors import AWSConnector, DatabaseConnector, MongoConnector
+try:
+    import connectorx as cx
+except ImportError:
+    cx = None
+from data_connectors import AsyncAWSConnector, DatabaseConnector, MongoConnector
 from database_queries import s3_upsert_to_redshift
 
+logger = logging.getLogger(__name__)
+
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
-                    level=logging.DEBUG,
+                    level=logging.INFO,
                     filename='stori.log')
 
 # In production, this could be moved into a config file.
@@ -43,42 +52,79 @@ config_dict = {"aws_access_key_id": str(os.getenv("AWS_ACCESS_KEY_ID")),
                }
 
 
+def get_s3_connector():
+    """
+    Builds the S3 connector used to stage data for Redshift.
+    """
+    return AsyncAWSConnector(conn_type='s3',
+                             aws_access_key_id=config_dict["aws_access_key_id"],
+                             aws_secret_access_key=config_dict["aws_secret_access_key"])
+
+
+def flatten_record(record, prefix=""):
+    """
+    Flattens nested dictionaries into a single level, joining keys with a
+    "." in the same way as pandas.json_normalize. Lists are left as-is.
+    :param record: dict: The record to flatten
+    :param prefix: str: The key prefix of the parent dictionary
+    """
+    flat_record = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            flat_record.update(flatten_record(value, prefix=f"{prefix}{key}."))
+        else:
+            flat_record[f"{prefix}{key}"] = value
+    return flat_record
+
+
 class TradesData:
     """
     This class encapsulates all transformations and interactions
     with trades data to move it from the source (MongoDB)
     to our data warehouse.
+    :param s3_conn: AWSConnector: Optional S3 connector shared between pipelines
     """
-    def __init__(self):
+    def __init__(self, s3_conn=None):
         self.raw_data = None
-        self.dataframe = None
+        self.records = None
+        self.columns = None
         self.clean_data = None
-        self.s3_conn = AWSConnector(conn_type='s3',
-                                    aws_access_key_id=config_dict["aws_access_key_id"],
-                                    aws_secret_access_key=config_dict["aws_secret_access_key"])
+        self.manifest_file = None
+        self.s3_conn = s3_conn or get_s3_connector()
 
     def get_trades_data(self):
         """
-        This will fetch all recent trades data from Mongo and upload
-        it into the self.raw_data variable.
+        This will fetch the recent trades document from Mongo and upload
+        it into the self.raw_data variable. Only the first document is
+        used downstream, so only that document is pulled over the wire.
         """
         with MongoConnector(host=config_dict["mongo_host"]) as mongo:
-            self.raw_data = list(mongo[config_dict["mongo_db"]].trades.find())
+            self.raw_data = list(mongo[config_dict["mongo_db"]].trades.find().limit(1))
 
     def normalize_data(self):
         """
-        This flattens the raw .jsons and places it into self.dataframe.
+        This flattens the raw .jsons into self.records and collects their
+        columns into self.columns. The raw documents are released once
+        they have been flattened.
         """
-        self.dataframe = pd.json_normalize(self.raw_data[0]["data"])
+        self.records = [flatten_record(record) for record in self.raw_data[0]["data"]]
+        self.columns = list(dict.fromkeys(key for record in self.records for key in record))
+        self.raw_data = None
 
     def stage_dataframe(self):
         """
-        This stages the flattened .json in S3 for upload to Redshift.
+        This stages the flattened .json in S3 as newline-delimited json
+        for upload to Redshift.
         """
+        content = b"\n".join(orjson.dumps(record) for record in self.records)
+        file_name = f'trades_{datetime.now(timezone.utc).isoformat()}'
         self.s3_conn.put_s3_items(bucket=config_dict["trades_aws_bucket"],
-                                  file_name=f'trades_{datetime.utcnow()}.json',
-                                  content=self.dataframe.to_json(orient='records',
-                                                                 lines=True))
+                                  file_name=f'{file_name}.json',
+                                  content=content)
+        self.manifest_file = f'{file_name}.manifest'
+        self.s3_conn.put_s3_manifest(bucket=config_dict["trades_aws_bucket"],
+                                     file_name=self.manifest_file,
+                                     entries={f'{file_name}.json': len(content)})
 
     def upsert_to_redshift(self):
         """
@@ -96,12 +142,13 @@ class TradesData:
                 s3_upsert_to_redshift(conn=conn,
                                       schema=config_dict["trades_redshift_schema"],
                                       redshift_table=config_dict["trades_redshift_table"],
-                                      s3_conn_str=config_dict["trades_bucket_con_string"],
+                                      s3_conn_str=f'{config_dict["trades_bucket_con_string"]}/{self.manifest_file}',
                                       primary_key=config_dict["trades_primary_key"],
                                       aws_access_key_id=config_dict["aws_access_key_id"],
                                       aws_secret_access_key=config_dict["aws_secret_access_key"],
-                                      dataframe=self.dataframe,
-                                      additional_params="JSON AS 'auto'")
+                                      dataframe=None,
+                                      additional_params="JSON AS 'auto' MANIFEST",
+                                      columns=self.columns)
 
     def cleanup_s3(self):
         """
@@ -113,25 +160,43 @@ class TradesData:
                                                       method='delete'):
             pass
 
+    def run(self):
+        """
+        Runs the full trades pipeline. S3 is always cleaned up,
+        even if one of the earlier steps fails.
+        """
+        try:
+            self.get_trades_data()
+            self.normalize_data()
+            self.stage_dataframe()
+            self.upsert_to_redshift()
+        finally:
+            self.cleanup_s3()
+
 
 class TransactionsData:
     """
     This class encapsulates all transformations and interactions
     with transaction data to move it from the source (PostgreSQL DB)
     to our data warehouse.
+    :param s3_conn: AWSConnector: Optional S3 connector shared between pipelines
     """
 
-    def __init__(self):
+    def __init__(self, s3_conn=None):
         self.dataframe = None
+        self.columns = None
+        self.copy_params = None
         self.clean_data = None
-        self.s3_conn = AWSConnector(conn_type='s3',
-                                    aws_access_key_id=config_dict["aws_access_key_id"],
-                                    aws_secret_access_key=config_dict["aws_secret_access_key"])
+        self.manifest_file = None
+        self.s3_conn = s3_conn or get_s3_connector()
 
-    def get_transact_data(self):
+    def stream_transact_data(self):
         """
-        This method lost the most recent data from the postgres db
-        into a dataframe.
+        This method streams the most recent data from the postgres db
+        straight into the s3 bucket as a .csv via COPY ... TO STDOUT,
+        without building a dataframe. It replaces get_transact_data and
+        stage_dataframe when the data does not need to pass through pandas.
+        NULLs are written as \\N so that Redshift does not load them as ''.
         """
 
         with DatabaseConnector(host=config_dict["postgres_db_host"],
@@ -144,6 +209,49 @@ class TransactionsData:
                 _schema = config_dict["transaction_postgres_schema"]
                 _table = config_dict["transaction_postgres_table"]
                 _sql_statement = f"""SELECT * FROM {_schema}.{_table}"""
+                with conn.connection.cursor() as cursor:
+                    cursor.execute(f"""{_sql_statement} LIMIT 0""")
+                    self.columns = [column[0] for column in cursor.description]
+
+                    file_name = f'transactions_{datetime.now(timezone.utc).isoformat()}'
+                    with self.s3_conn.open_s3_writer(bucket=config_dict["transaction_aws_bucket"],
+                                                     file_name=f'{file_name}.csv') as sink:
+                        cursor.copy_expert(f"""COPY ({_sql_statement}) TO STDOUT WITH (FORMAT CSV, NULL '\\N')""", sink)
+
+        self.manifest_file = f'{file_name}.manifest'
+        self.s3_conn.put_s3_manifest(bucket=config_dict["transaction_aws_bucket"],
+                                     file_name=self.manifest_file,
+                                     entries={f'{file_name}.csv': sink.bytes_written})
+        self.copy_params = "FORMAT AS CSV NULL AS '\\\\N' MANIFEST"
+
+    def get_transact_data(self):
+        """
+        This method lost the most recent data from the postgres db
+        into a dataframe. If the optional connectorx extra is installed,
+        the table is read in parallel partitions straight into Arrow;
+        otherwise it uses pandas.read_sql.
+        """
+
+        postgres_db = DatabaseConnector(host=config_dict["postgres_db_host"],
+                                        port=config_dict["postgres_db_port"],
+                                        user=config_dict["postgres_user"],
+                                        password=config_dict["postgres_pass"],
+                                        database=config_dict["postgres_db"],
+                                        dialect=config_dict["postgres_dialect"])
+        _schema = config_dict["transaction_postgres_schema"]
+        _table = config_dict["transaction_postgres_table"]
+        _sql_statement = f"""SELECT * FROM {_schema}.{_table}"""
+
+        if cx is not None:
+            self.dataframe = cx.read_sql(postgres_db.url,
+                                         _sql_statement,
+                                         partition_on=config_dict["transaction_primary_key"],
+                                         partition_num=8,
+                                         return_type="pandas")
+            return
+
+        with postgres_db as engine:
+            with engine.begin() as conn:
                 self.dataframe = pd.read_sql(_sql_statement, con=conn)
 
     def format_dataframe(self):
@@ -163,20 +271,30 @@ class TransactionsData:
                                                         " WITHDRAWAL AMT ": "withdrawal_amt",
                                                         " DEPOSIT AMT ": "deposit_amt",
                                                         "BALANCE AMT": "balance_amt"})
-        self.dataframe["date"] = pd.to_datetime(self.dataframe["date"])
-        self.dataframe["value_date"] = pd.to_datetime(self.dataframe["value_date"])
+        for col in ["date", "value_date"]:
+            self.dataframe[col] = pd.to_datetime(self.dataframe[col], format="%d-%b-%y", cache=True)
         for col in ["withdrawal_amt", "deposit_amt", "balance_amt"]:
-            self.dataframe[col] = self.dataframe[col].apply(lambda x: str(x).strip())
-            self.dataframe[col] = self.dataframe[col].apply(lambda x: str(x).replace(",", ""))
-            self.dataframe[col] = self.dataframe[col].astype('float')
+            self.dataframe[col] = (self.dataframe[col].astype(str)
+                                                      .str.strip()
+                                                      .str.replace(",", "", regex=False)
+                                                      .astype('float64'))
 
     def stage_dataframe(self):
-        """This method is used to stage the cleaned, .csv version of the dataframe
-        into the s3 bucket."""
+        """This method is used to stage the cleaned, snappy-compressed parquet
+        version of the dataframe into the s3 bucket."""
 
+        buffer = io.BytesIO()
+        self.dataframe.to_parquet(buffer, engine="pyarrow", compression="snappy", index=False)
+        content = buffer.getvalue()
+        file_name = f'transactions_{datetime.now(timezone.utc).isoformat()}'
         self.s3_conn.put_s3_items(bucket=config_dict["transaction_aws_bucket"],
-                                  file_name=f'transactions_{datetime.utcnow()}.csv',
-                                  content=self.dataframe.to_csv(index=False, header=False))
+                                  file_name=f'{file_name}.parquet',
+                                  content=content)
+        self.manifest_file = f'{file_name}.manifest'
+        self.s3_conn.put_s3_manifest(bucket=config_dict["transaction_aws_bucket"],
+                                     file_name=self.manifest_file,
+                                     entries={f'{file_name}.parquet': len(content)})
+        self.copy_params = "FORMAT AS PARQUET MANIFEST"
 
     def upsert_to_redshift(self):
         """
@@ -195,12 +313,13 @@ class TransactionsData:
                 s3_upsert_to_redshift(conn=conn,
                                       schema=config_dict["transaction_redshift_schema"],
                                       redshift_table=config_dict["transaction_redshift_table"],
-                                      s3_conn_str=config_dict["transaction_bucket_con_string"],
+                                      s3_conn_str=f'{config_dict["transaction_bucket_con_string"]}/{self.manifest_file}',
                                       primary_key=config_dict["transaction_primary_key"],
                                       aws_access_key_id=config_dict["aws_access_key_id"],
                                       aws_secret_access_key=config_dict["aws_secret_access_key"],
                                       dataframe=self.dataframe,
-                                      additional_params="DELIMITER ','")
+                                      additional_params=self.copy_params,
+                                      columns=self.columns)
 
     def cleanup_s3(self):
         """
@@ -212,6 +331,24 @@ class TransactionsData:
                                                       method='delete'):
             pass
 
+    def run(self, use_pandas=False):
+        """
+        Runs the full transactions pipeline. S3 is always cleaned up,
+        even if one of the earlier steps fails.
+        :param use_pandas: bool: default False. If this is True, the data is
+        loaded into a dataframe and staged as parquet instead of being
+        streamed straight from postgres into S3 as a .csv.
+        """
+        try:
+            if use_pandas is True:
+                self.get_transact_data()
+                self.stage_dataframe()
+            else:
+                self.stream_transact_data()
+            self.upsert_to_redshift()
+        finally:
+            self.cleanup_s3()
+
 
 def main():
     """
@@ -220,23 +357,24 @@ def main():
     # If we wanted to individually control
     # what tables are updated, sys.argv could be used
     # to call each data set independently via a cron job.
-    # if sys.argv[1] == 'transactions':
-    transact_connector = TransactionsData()
-    transact_connector.get_transact_data()
-    transact_connector.stage_dataframe()
-    transact_connector.upsert_to_redshift()
-    transact_connector.cleanup_s3()
-
-    # if sys.argv[1] == 'trades':
-    trades_connector = TradesData()
-    trades_connector.get_trades_data()
-    trades_connector.normalize_data()
-    trades_connector.stage_dataframe()
-    trades_connector.upsert_to_redshift()
-    trades_connector.cleanup_s3()
-
-    # TODO: Add exception handling to clean up
-    # S3 on errors.
+    # Both pipelines are I/O bound and share no data, so they run concurrently.
+    s3_conn = get_s3_connector()
+    pipelines = {"transactions": TransactionsData(s3_conn=s3_conn), "trades": TradesData(s3_conn=s3_conn)}
+    with ThreadPoolExecutor(max_workers=len(pipelines)) as executor:
+        futures = {name: executor.submit(pipeline.run) for name, pipeline in pipelines.items()}
+
+    # Both pipelines are allowed to finish before failing, so that one
+    # failed load does not hide the other.
+    failures = {}
+    for name, future in futures.items():
+        try:
+            future.result()
+        except Exception as exc:
+            logger.exception(f"The {name} pipeline failed.")
+            failures[name] = exc
+
+    if failures:
+        raise RuntimeError(f"Pipelines failed: {', '.join(failures)}") from next(iter(failures.values()))
 
 
 if __name__ == "__main__":